@@ -6,8 +6,9 @@ en utilisant exclusivement le script local `fraude_detect_admi.py`.
 
 - Page d'accueil: procédure et bouton Continuer
 - Page /dates: saisie des dates (validation serveur)
-- Lancement du traitement: exécution du script en sous-processus avec la fenêtre
-  temporelle transmise via ADMI_WINDOW_DAYS et sortie dans un dossier isolé
+- Lancement du traitement: exécution du script en sous-processus asynchrone avec
+  la fenêtre temporelle transmise via ADMI_WINDOW_DAYS et sortie dans un dossier
+  isolé ; l'état du job est suivi dans une petite base SQLite
 - Page /resultats: résumé, tableau paginé (15 lignes/page), téléchargement CSV & DOCX
 - Gestion d'erreurs et messages clairs (flash)
 - Couleurs FPM (#006b01) et police Tahoma
@@ -16,11 +17,22 @@ import os
 import io
 import csv
 import json
+import mmap
+import uuid
 import shutil
+import time
+import asyncio
+import sqlite3
+import threading
+import itertools
 import traceback
-from datetime import datetime, date
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import datetime, date, timedelta
 from pathlib import Path
-from subprocess import run, PIPE, CalledProcessError
+from subprocess import PIPE, CalledProcessError
 
 from flask import (
     Flask, render_template, request, redirect, url_for, flash,
@@ -31,9 +43,17 @@ from flask import (
 BASE_DIR = Path(__file__).resolve().parent
 REPORTS_ROOT = BASE_DIR / "reports"  # chaque exécution aura un sous-dossier daté
 DEFAULT_PROCESSOR = BASE_DIR / "fraude_detect_admi.py"  # script fourni par défaut
+JOBS_DB = REPORTS_ROOT / "jobs.sqlite3"  # état des traitements (pending/done/failed)
 
 REPORTS_ROOT.mkdir(exist_ok=True, parents=True)
 
+# Les traitements tournent hors du worker HTTP
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("FRAUDE_MAX_JOBS", "2")))
+# Un job vivant rafraîchit heartbeat_at ; sans signe de vie depuis JOB_STALE_S
+# (serveur redémarré, thread perdu), il est marqué en échec.
+JOB_HEARTBEAT_S = 5
+JOB_STALE_S = max(3 * JOB_HEARTBEAT_S, int(os.environ.get("FRAUDE_JOB_STALE_S", "30")))
+
 def create_app():
     app = Flask(__name__)
     app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-secret-change-me")
@@ -60,10 +80,54 @@ def build_run_folder() -> Path:
     return out
 
 def paginate(rows, page: int, per_page: int = 15):
-    total = len(rows)
+    # Itérable consommé jusqu'à la fin de la page seulement (rien d'autre en mémoire)
+    start = (page - 1) * per_page
+    return list(itertools.islice(rows, start, start + per_page))
+
+def csv_index_path(csv_path: Path) -> Path:
+    return csv_path.with_suffix(".idx")
+
+def build_csv_index(csv_path: Path) -> int:
+    """Écrit <csv>.idx : offset (uint64) du début de chaque ligne de données.
+    Retourne le nombre de lignes (hors en-tête)."""
+    offsets = array("Q")
+    with csv_path.open("rb") as f:
+        pos = len(f.readline())  # en-tête
+        in_quotes = False  # champ entre guillemets sur plusieurs lignes physiques
+        for line in iter(f.readline, b""):
+            if not in_quotes:
+                offsets.append(pos)
+            if line.count(b'"') % 2:
+                in_quotes = not in_quotes
+            pos += len(line)
+    with csv_index_path(csv_path).open("wb") as f:
+        offsets.tofile(f)
+    return len(offsets)
+
+@lru_cache(maxsize=64)
+def csv_headers(csv_path: str, mtime: float):
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        return next(csv.reader(f), [])
+
+def read_page(csv_path: Path, page: int, per_page: int = 15):
+    """Lit une page via l'index d'offsets (seek direct) -> (headers, rows, total)."""
+    headers = csv_headers(str(csv_path), csv_path.stat().st_mtime)
+    idx_path = csv_index_path(csv_path)
+    total = idx_path.stat().st_size // array("Q").itemsize
     start = (page - 1) * per_page
-    end = start + per_page
-    return rows[start:end], total
+    if start >= total:
+        return headers, [], total
+
+    with idx_path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets = memoryview(mm).cast("Q")
+        offset = offsets[start]
+        offsets.release()
+
+    with csv_path.open("rb") as raw:
+        raw.seek(offset)
+        reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8", newline=""))
+        rows = list(itertools.islice(reader, per_page))
+    return headers, rows, total
 
 def generate_docx(summary: dict, csv_path: Path, out_docx: Path):
     # Génère un rapport Word simple avec python-docx
@@ -90,21 +154,184 @@ def generate_docx(summary: dict, csv_path: Path, out_docx: Path):
             headers = []
             rows = []
         else:
-            rows = [next(reader) for _ in range(20) if True]
+            rows = list(itertools.islice(reader, 20))
 
     if headers:
-        table = doc.add_table(rows=1, cols=len(headers))
-        hdr_cells = table.rows[0].cells
-        for j, h in enumerate(headers):
-            hdr_cells[j].text = h
-
-        for row in rows:
-            row_cells = table.add_row().cells
-            for j, val in enumerate(row):
-                row_cells[j].text = str(val)
+        # Table sérialisée en une chaîne XML, analysée une seule fois puis insérée
+        # dans le corps (l'API cellule par cellule reparcourt la table à chaque ajout)
+        from xml.sax.saxutils import escape
+        from docx.oxml import parse_xml
+        from docx.oxml.ns import nsdecls
+        from docx.shared import Emu
+
+        section = doc.sections[-1]
+        width = section.page_width - section.left_margin - section.right_margin
+        col_w = Emu(width // len(headers)).twips
+        tbl_xml = (
+            f'<w:tbl {nsdecls("w")}>'
+            '<w:tblPr><w:tblW w:type="auto" w:w="0"/>'
+            '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0"'
+            ' w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+            '<w:tblGrid>' + f'<w:gridCol w:w="{col_w}"/>' * len(headers) + '</w:tblGrid>'
+            + "".join(
+                "<w:tr>" + "".join(
+                    f'<w:tc><w:p><w:r><w:t xml:space="preserve">{escape(str(val))}</w:t></w:r></w:p></w:tc>'
+                    for val in values
+                ) + "</w:tr>"
+                for values in [headers] + rows
+            )
+            + '</w:tbl>'
+        )
+        doc.element.body.sectPr.addprevious(parse_xml(tbl_xml))
 
     doc.save(out_docx)
 
+# --------- Jobs ---------
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+@contextmanager
+def jobs_db():
+    conn = sqlite3.connect(JOBS_DB, timeout=10)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:  # commit / rollback
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    folder TEXT NOT NULL,
+                    summary TEXT,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    heartbeat_at TEXT
+                )
+            """)
+            cols = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat_at" not in cols:  # base créée par une version antérieure
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at TEXT")
+            yield conn
+    finally:
+        conn.close()
+
+def create_job(out_folder: Path) -> str:
+    job_id = uuid.uuid4().hex
+    with jobs_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, folder, created_at, heartbeat_at) VALUES (?, 'pending', ?, ?, ?)",
+            (job_id, str(out_folder), now_iso(), now_iso())
+        )
+    return job_id
+
+# Jobs suivis par ce processus (en file d'attente ou en cours)
+ACTIVE_JOBS = set()
+ACTIVE_LOCK = threading.Lock()
+
+def heartbeat():
+    # Thread démon : meurt avec le processus Flask, ce qui rend ses jobs
+    # détectables comme orphelins
+    while True:
+        time.sleep(JOB_HEARTBEAT_S)
+        with ACTIVE_LOCK:
+            ids = list(ACTIVE_JOBS)
+        if not ids:
+            continue
+        try:
+            with jobs_db() as conn:
+                conn.execute(
+                    f"UPDATE jobs SET heartbeat_at = ? WHERE id IN ({','.join('?' * len(ids))})",
+                    [now_iso(), *ids]
+                )
+        except sqlite3.Error:
+            pass  # base verrouillée : nouvel essai au prochain battement
+
+def fail_stale_jobs(job_id: str = None):
+    """Passe en 'failed' les jobs 'pending' sans heartbeat récent (tous, ou `job_id`)."""
+    cutoff = (datetime.now() - timedelta(seconds=JOB_STALE_S)).isoformat(timespec="seconds")
+    sql = ("UPDATE jobs SET status = 'failed', error = ? WHERE status = 'pending'"
+           " AND COALESCE(heartbeat_at, created_at) < ?")
+    params = ["Traitement interrompu (redémarrage du serveur ?). Veuillez le relancer.", cutoff]
+    if job_id:
+        sql += " AND id = ?"
+        params.append(job_id)
+    with jobs_db() as conn:
+        conn.execute(sql, params)
+
+def update_job(job_id: str, status: str, summary: dict = None, error: str = None):
+    with jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, summary = ?, error = ? WHERE id = ?",
+            (status, json.dumps(summary) if summary else None, error, job_id)
+        )
+
+def get_job(job_id: str):
+    fail_stale_jobs(job_id)
+    with jobs_db() as conn:
+        return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+async def pipe_to_log(stream, log, prefix=b""):
+    # Copie ligne à ligne : mémoire O(ligne) quelle que soit la taille des sorties
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        log.write(prefix + line)
+        log.flush()
+
+async def run_processor(cmd, env, log_path: Path) -> int:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, cwd=str(BASE_DIR), stdout=PIPE, stderr=PIPE, env=env
+    )
+    with log_path.open("ab") as log:
+        await asyncio.gather(
+            pipe_to_log(proc.stdout, log),
+            pipe_to_log(proc.stderr, log, b"[STDERR] "),
+        )
+    return await proc.wait()
+
+def run_job(job_id: str, out_folder: Path, d1: date, d2: date, env: dict):
+    try:
+        cmd = [os.environ.get("PYTHON_BIN", "python"), str(DEFAULT_PROCESSOR)]
+        returncode = asyncio.run(run_processor(cmd, env, out_folder / "execution.log"))
+        if returncode != 0:
+            raise CalledProcessError(returncode, cmd)
+
+        csv_all = out_folder / "auto_all.csv"
+        if not csv_all.exists():
+            # Cherche un CSV alternatif si le principal n'est pas présent
+            candidates = list(out_folder.glob("auto_*.csv"))
+            if not candidates:
+                raise RuntimeError("Aucun fichier de résultats n'a été généré.")
+            csv_all = candidates[0]
+
+        # Indexe le CSV (offsets de lignes) : donne le total et la pagination directe
+        nb_total = build_csv_index(csv_all)
+
+        summary = {
+            "debut": d1.isoformat(),
+            "fin": d2.isoformat(),
+            "nb_total": int(nb_total),
+            "folder": str(out_folder),
+            "csv": str(csv_all.name)
+        }
+
+        # Génère DOCX
+        try:
+            docx_path = out_folder / "rapport_fraudes.docx"
+            generate_docx(summary, csv_all, docx_path)
+        except Exception as e:
+            (out_folder / "docx_error.txt").write_text(str(e), encoding="utf-8")
+
+        update_job(job_id, "done", summary=summary)
+
+    except Exception as e:
+        # Log erreur globale
+        (out_folder / "fatal_error.txt").write_text(traceback.format_exc(), encoding="utf-8")
+        update_job(job_id, "failed", error=str(e))
+    finally:
+        with ACTIVE_LOCK:
+            ACTIVE_JOBS.discard(job_id)
+
 # --------- Routes ---------
 @app.route("/")
 def index():
@@ -131,61 +358,39 @@ def dates():
             env = os.environ.copy()
             env["ADMI_WINDOW_DAYS"] = str(days)
             env["ADMI_OUT_DIR"] = str(out_folder)  # contiendra auto_all.csv
+            env["PYTHONUNBUFFERED"] = "1"  # logs écrits au fil de l'eau
+            env["PYTHONIOENCODING"] = "utf-8"
 
-            proc = run(
-                [os.environ.get("PYTHON_BIN", "python"), str(DEFAULT_PROCESSOR)],
-                cwd=str(BASE_DIR),
-                stdout=PIPE, stderr=PIPE, text=True, env=env, timeout=None
-            )
-            log_txt = (out_folder / "execution.log")
-            log_txt.write_text(proc.stdout + "\n\n[STDERR]\n" + proc.stderr, encoding="utf-8")
-
-            if proc.returncode != 0:
-                raise CalledProcessError(proc.returncode, proc.args, proc.stdout, proc.stderr)
-
-            csv_all = out_folder / "auto_all.csv"
-            if not csv_all.exists():
-                # Cherche un CSV alternatif si le principal n'est pas présent
-                candidates = list(out_folder.glob("auto_*.csv"))
-                if not candidates:
-                    raise RuntimeError("Aucun fichier de résultats n'a été généré.")
-                csv_all = candidates[0]
-
-            # Lis le CSV pour le résumé
-            import pandas as pd
-            df = pd.read_csv(csv_all)
-            nb_total = len(df.index)
-
-            # Résumé en session
-            session["summary"] = {
-                "debut": d1.isoformat(),
-                "fin": d2.isoformat(),
-                "nb_total": int(nb_total),
-                "folder": str(out_folder),
-                "csv": str(csv_all.name)
-            }
-
-            # Génère DOCX
-            try:
-                docx_path = out_folder / "rapport_fraudes.docx"
-                generate_docx(session["summary"], csv_all, docx_path)
-            except Exception as e:
-                (out_folder / "docx_error.txt").write_text(str(e), encoding="utf-8")
-
-            return redirect(url_for("resultats"))
-
+            job_id = create_job(out_folder)
+            with ACTIVE_LOCK:
+                ACTIVE_JOBS.add(job_id)
+            EXECUTOR.submit(run_job, job_id, out_folder, d1, d2, env)
         except Exception as e:
-            traceback_txt = traceback.format_exc()
-            flash(f"Erreur pendant le traitement: {e}", "error")
-            # Log erreur globale
-            (out_folder / "fatal_error.txt").write_text(traceback_txt, encoding="utf-8")
+            flash(f"Erreur au lancement du traitement: {e}", "error")
             return redirect(url_for("dates"))
 
+        # 202 : le traitement continue en arrière-plan, la page interroge /resultats
+        return render_template("en_cours.html", job_id=job_id), 202
+
     # GET
     return render_template("dates.html")
 
 @app.route("/resultats")
 def resultats():
+    job_id = request.args.get("job")
+    if job_id:
+        job = get_job(job_id)
+        if job is None:
+            flash("Traitement introuvable. Veuillez relancer un traitement.", "error")
+            return redirect(url_for("dates"))
+        if job["status"] == "pending":
+            return render_template("en_cours.html", job_id=job_id), 202
+        if job["status"] == "failed":
+            flash(f"Erreur pendant le traitement: {job['error']}", "error")
+            return redirect(url_for("dates"))
+        session["summary"] = json.loads(job["summary"])
+        return redirect(url_for("resultats"))
+
     summary = session.get("summary")
     if not summary:
         flash("Aucun résultat disponible. Veuillez relancer un traitement.", "error")
@@ -195,10 +400,17 @@ def resultats():
     csv_name = summary.get("csv", "auto_all.csv")
     csv_path = folder / csv_name
 
-    # Lecture complète pour pagination
+    page = max(1, int(request.args.get("page", "1")))
+    per_page = 15
+
     headers = []
-    rows = []
-    if csv_path.exists():
+    page_rows, total = [], 0
+    if csv_path.exists() and csv_index_path(csv_path).exists():
+        headers, page_rows, total = read_page(csv_path, page, per_page)
+    elif csv_path.exists():
+        # Rapport sans index (exécutions antérieures) : lecture séquentielle
+        # jusqu'à la page demandée, total repris du résumé
+        total = int(summary.get("nb_total", 0))
         with csv_path.open("r", encoding="utf-8", newline="") as f:
             reader = csv.reader(f)
             try:
@@ -206,11 +418,7 @@ def resultats():
             except StopIteration:
                 headers = []
             else:
-                rows = list(reader)
-
-    page = max(1, int(request.args.get("page", "1")))
-    per_page = 15
-    page_rows, total = paginate(rows, page, per_page)
+                page_rows = paginate(reader, page, per_page)
     last_page = max(1, (total + per_page - 1) // per_page)
 
     return render_template(
@@ -237,5 +445,9 @@ def too_large(e):
     flash("Fichier trop volumineux.", "error")
     return redirect(url_for("dates"))
 
+# Jobs laissés 'pending' par un processus précédent (rechargement debug, arrêt)
+fail_stale_jobs()
+threading.Thread(target=heartbeat, daemon=True).start()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -8,9 +8,23 @@ Détection automatique des fraudes T1..T4 depuis MySQL 'admi'
 """
 
 import os
+import glob
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from urllib.parse import quote
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from sqlalchemy import TextClause, create_engine, text
+
+try:  # optionnel : décodage MySQL -> Arrow en Rust, sans tuples Python par ligne
+    import connectorx as cx
+except ImportError:
+    cx = None
 
 # =========================
 # 1) PARAMÈTRES
@@ -26,11 +40,26 @@ T2_TOLERANCE_PCT  = float(os.getenv("ADMI_T2_TOL_PCT", "0.00"))   # 0.10 = 10%
 T3_MIN_ACTES_7J   = int(os.getenv("ADMI_T3_MIN_ACTES_7J", "4"))
 T3_MIN_ECARTS_7J  = int(os.getenv("ADMI_T3_MIN_ECARTS_7J", "2"))
 T4_MIN_STRUCTS_J  = int(os.getenv("ADMI_T4_MIN_STRUCTS_JOUR", "2"))
+CHUNK_SIZE        = int(os.getenv("ADMI_CHUNK_SIZE", "200000"))   # lignes lues par bloc
+WORKERS           = int(os.getenv("ADMI_WORKERS", "5"))           # détections en parallèle
 
 OUT_DIR = os.getenv("ADMI_OUT_DIR", "reports")
 os.makedirs(OUT_DIR, exist_ok=True)
+# Cache Parquet des référentiels entre deux exécutions ("" pour désactiver)
+CACHE_DIR = os.getenv("ADMI_CACHE_DIR", os.path.join("reports", ".cache"))
+# Âge maximal d'un fichier de cache (heures) : borne la durée de vie des UPDATE
+# en place (nom, téléphone...) que COUNT(*)/MAX(key) ne voient pas.
+CACHE_MAX_AGE_H = float(os.getenv("ADMI_CACHE_MAX_AGE_H", "24"))
 DATE_MIN = (datetime.today() - timedelta(days=WINDOW_DAYS)).date()
 
+# Les détections tournent en parallèle : chaque message est écrit d'un bloc,
+# sous verrou, pour ne pas entremêler les lignes de execution.log.
+_LOG_LOCK = threading.Lock()
+
+def log(msg):
+    with _LOG_LOCK:
+        print(msg, flush=True)
+
 # =========================
 # 2) CONNEXION
 # =========================
@@ -38,51 +67,239 @@ engine = create_engine(
     f"mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}",
     pool_recycle=3600, pool_pre_ping=True
 )
+CX_URI = f"mysql://{quote(DB_USER)}:{quote(DB_PASS)}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Dernier tarif conventionnel par acte (avenant le plus récent)
+SQL_TARIF_LAST = """
+    SELECT ac.id_acte, ac.forfait_acte_convention AS tarif_officiel
+    FROM actes_convention ac
+    JOIN (SELECT id_acte, MAX(id_avenant) AS mx
+          FROM actes_convention GROUP BY id_acte) m
+      ON m.id_acte = ac.id_acte AND m.mx = ac.id_avenant
+"""
+
+# T3 : nb d'actes / nb d'écarts positifs sur 7 jours glissants par
+# (structure, bénéficiaire). Index conseillé :
+#   acte_trans (id_structure, id_beneficiaire, date_soin)
+SQL_T3 = f"""
+    SELECT id_structure, id_beneficiaire,
+           MIN(debut_7j)         AS periode_debut,
+           MAX(date_soin)        AS periode_fin,
+           MAX(nb_actes_7j)      AS nb_actes_7j,
+           MAX(nb_ecarts_pos_7j) AS nb_ecarts_pos_7j
+    FROM (
+        SELECT x.id_structure, x.id_beneficiaire, x.date_soin,
+               MIN(x.date_soin) OVER w AS debut_7j,
+               COUNT(*) OVER w AS nb_actes_7j,
+               SUM(CASE WHEN x.ecart_montant > 0 THEN 1 ELSE 0 END) OVER w AS nb_ecarts_pos_7j
+        FROM (
+            SELECT tr.id_structure, tr.id_beneficiaire, tr.date_soin,
+                   la.montant_acte - COALESCE(tf.tarif_officiel, 0) AS ecart_montant
+            FROM list_acte_acte_trans la
+            JOIN acte_trans tr ON tr.id_acte_trans = la.id_acte_trans
+            LEFT JOIN ({SQL_TARIF_LAST}) tf ON tf.id_acte = la.id_acte
+            WHERE tr.date_soin >= :dmin
+              AND tr.id_beneficiaire IS NOT NULL
+        ) x
+        WINDOW w AS (PARTITION BY x.id_structure, x.id_beneficiaire
+                     ORDER BY x.date_soin
+                     RANGE BETWEEN INTERVAL 7 DAY PRECEDING AND CURRENT ROW)
+    ) f
+    WHERE f.nb_actes_7j >= :t3n AND f.nb_ecarts_pos_7j >= :t3e
+    GROUP BY id_structure, id_beneficiaire
+"""
+
+# Faits lus par blocs, projetés par typologie : transactions (T1a), lignes sans
+# date d'exécution (T1b) et transactions ayant au moins une ligne (ids pour
+# T1a). Le bénéficiaire est injecté selon le schéma : {benef} (table
+# seule) ou {benef_tr} (acte_trans aliasée `tr`).
+SQL_ACTE_TRANS = """
+    SELECT id_acte_trans, id_structure, id_type_prest, date_soin, {benef}
+    FROM acte_trans
+    WHERE date_soin >= :dmin
+"""
+
+SQL_T1B = """
+    SELECT la.id_acte_trans, la.id_acte, la.montant_acte,
+           tr.id_structure, tr.id_type_prest, tr.date_soin, {benef_tr}
+    FROM list_acte_acte_trans la
+    JOIN acte_trans tr ON tr.id_acte_trans = la.id_acte_trans
+    WHERE tr.date_soin >= :dmin
+      AND la.date_execution_acte IS NULL
+"""
+
+SQL_FLUX = """
+    SELECT DISTINCT la.id_acte_trans
+    FROM list_acte_acte_trans la
+    JOIN acte_trans tr ON tr.id_acte_trans = la.id_acte_trans
+    WHERE tr.date_soin >= :dmin
+"""
+
+# T4 : même bénéficiaire, même jour, >= N structures distinctes (transactions
+# avec au moins une ligne d'acte). Seuls les couples suspects remontent.
+SQL_T4 = """
+    SELECT tr.id_beneficiaire, DATE(tr.date_soin) AS jour,
+           COUNT(DISTINCT tr.id_structure) AS nb_structures,
+           GROUP_CONCAT(DISTINCT tr.id_structure ORDER BY tr.id_structure SEPARATOR ',') AS structures
+    FROM acte_trans tr
+    WHERE tr.date_soin >= :dmin
+      AND tr.id_beneficiaire IS NOT NULL
+      AND EXISTS (SELECT 1 FROM list_acte_acte_trans la
+                  WHERE la.id_acte_trans = tr.id_acte_trans)
+    GROUP BY tr.id_beneficiaire, DATE(tr.date_soin)
+    HAVING COUNT(DISTINCT tr.id_structure) >= :n
+"""
+
+# T2 : lignes facturées au-delà du dernier tarif (+ tolérance). Index conseillé :
+#   actes_convention (id_acte, id_avenant)
+SQL_T2 = f"""
+    SELECT la.id_acte_trans, la.id_acte, la.date_execution_acte, la.montant_acte,
+           tr.id_structure, tr.id_type_prest, tr.date_soin, {{benef_tr}},
+           tf.tarif_officiel
+    FROM list_acte_acte_trans la
+    JOIN acte_trans tr ON tr.id_acte_trans = la.id_acte_trans
+    JOIN ({SQL_TARIF_LAST}) tf ON tf.id_acte = la.id_acte
+    WHERE tr.date_soin >= :dmin
+      AND la.montant_acte > tf.tarif_officiel * (1 + :tol)
+"""
 
-def q(conn, sql, params=None, name=""):
-    """SELECT helper robuste. Autorise q(conn, sql, 'nom')."""
+# Types resserrés dès la lecture : identifiants en entiers 32 bits (nullables) si
+# leurs bornes le permettent, libellés répétitifs des référentiels en category
+# -> moins d'octets par merge/groupby.
+ID_COLS = {"id_acte_trans","id_acte","id_structure","id_type_prest","id_beneficiaire",
+           "id_type_str_sante","id_adherent"}
+LABEL_COLS = {"nom_structure","libelle_type_structure_sante","libelle_type_prestation",
+              "code_prestation","code_acte","libelle_acte"}
+
+def id_dtype(col):
+    """Plus petit entier nullable contenant les valeurs : Int32, sinon UInt32
+    (INT UNSIGNED), sinon Int64 (BIGINT)."""
+    lo, hi = col.min(), col.max()
+    if pd.isna(lo):
+        return "Int32"
+    for dt in ("Int32", "UInt32"):
+        info = np.iinfo(dt.lower())
+        if info.min <= lo and hi <= info.max:
+            return dt
+    return "Int64"
+
+def narrow(df):
+    for c in df.columns:
+        if c in ID_COLS:
+            df[c] = df[c].astype(id_dtype(df[c]))
+        elif c in LABEL_COLS:
+            df[c] = df[c].astype("category")
+    return df
+
+def q(conn, sql, params=None, name="", chunksize=None):
+    """SELECT helper robuste. Autorise q(conn, sql, 'nom').
+    `sql` : texte ou requête text() déjà construite (réutilisée telle quelle).
+    Avec chunksize, renvoie un itérateur de DataFrames (lecture par blocs)."""
     if isinstance(params, str) and not name:
         name, params = params, None
-    df = pd.read_sql(text(sql), conn, params=params or {})
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] {name or sql.splitlines()[0][:65]} -> {len(df)} lignes")
+    stmt = sql if isinstance(sql, TextClause) else text(sql)
+    name = name or stmt.text.splitlines()[0][:65]
+    if chunksize:
+        return _q_chunks(conn, stmt, params, name, chunksize)
+    use_cx = cx is not None and not params and stmt.text.lstrip().upper().startswith("SELECT")
+    df = _q_cx(stmt.text, name) if use_cx else None
+    if df is None:
+        df = pd.read_sql(stmt, conn, params=params or {})
+    df = narrow(df)
+    log(f"[{datetime.now().strftime('%H:%M:%S')}] {name} -> {len(df)} lignes")
+    return df
+
+def _q_cx(sql, name):
+    # ConnectorX ne lie pas de paramètres ni ne lit par blocs : réservé aux
+    # lectures complètes sans paramètre (référentiels). None -> repli SQLAlchemy.
+    try:
+        return cx.read_sql(CX_URI, sql, return_type="arrow").to_pandas()
+    except Exception as e:
+        log(f"ATTENTION: connectorx indisponible pour {name} ({e}) -> pandas.read_sql.")
+        return None
+
+def _q_chunks(conn, stmt, params, name, chunksize):
+    # Curseur côté serveur : PyMySQL ne met plus tout le résultat en mémoire
+    # avant le premier bloc.
+    conn = conn.execution_options(stream_results=True)
+    n = 0
+    for df in pd.read_sql(stmt, conn, params=params or {}, chunksize=chunksize):
+        n += len(df)
+        yield narrow(df)
+    log(f"[{datetime.now().strftime('%H:%M:%S')}] {name} -> {n} lignes ({chunksize}/bloc)")
+
+def load_dim(conn, name, sql, key):
+    """Référentiel lu depuis le cache Parquet tant que COUNT(*)/MAX(key) de la
+    table `name` n'ont pas bougé et qu'il a moins de CACHE_MAX_AGE_H heures ;
+    sinon relu en base et remis en cache. La base source (hôte, port, nom) fait partie de la clé : deux bases ne
+    partagent jamais un fichier de cache."""
+    if not CACHE_DIR:
+        return q(conn, sql, name=name)
+    sig = conn.execute(text(f"SELECT COUNT(*), MAX({key}) FROM {name}")).fetchone()
+    source = (DB_HOST, DB_PORT, DB_NAME)
+    digest = hashlib.sha1(repr((source, sql, tuple(sig))).encode("utf-8")).hexdigest()[:16]
+    folder = os.path.join(CACHE_DIR, name)
+    path = os.path.join(folder, f"{digest}.parquet")
+    fresh = (os.path.exists(path) and
+             datetime.now().timestamp() - os.path.getmtime(path) < CACHE_MAX_AGE_H * 3600)
+    if fresh:
+        try:
+            df = pd.read_parquet(path)
+            log(f"[{datetime.now().strftime('%H:%M:%S')}] {name} -> {len(df)} lignes (cache)")
+            return df
+        except Exception as e:
+            log(f"ATTENTION: cache illisible {path} ({e}) -> relecture en base.")
+    df = q(conn, sql, name=name)
+    try:
+        # Écriture sous un nom temporaire puis os.replace : un job concurrent
+        # (FRAUDE_MAX_JOBS > 1) ne lit jamais un fichier à moitié écrit.
+        os.makedirs(folder, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+        for old in glob.glob(os.path.join(folder, "*.parquet")):
+            if old != path:
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+    except Exception as e:
+        log(f"ATTENTION: cache non écrit pour {name} ({e}).")
     return df
 
 # =========================
-# 3) LECTURE DES TABLES
+# 3) LECTURE DES RÉFÉRENTIELS
 # =========================
 with engine.begin() as conn:
     cols_at = q(conn, "SHOW COLUMNS FROM acte_trans", name="cols_acte_trans")
     has_benef = "id_beneficiaire" in cols_at["Field"].str.lower().tolist()
 
-    df_at = q(conn, f"""
-        SELECT id_acte_trans, id_structure, id_type_prest, date_soin,
-               { 'id_beneficiaire' if has_benef else 'NULL AS id_beneficiaire' }
-        FROM acte_trans
-        WHERE date_soin >= :dmin
-    """, {"dmin": DATE_MIN}, "acte_trans (90j)")
-
-    df_la = q(conn, """
-        SELECT id_list_acte_acte_trans, id_acte_trans, id_acte,
-               quantite, date_execution_acte, montant_acte
-        FROM list_acte_acte_trans
-        WHERE id_acte_trans IN (
-            SELECT id_acte_trans FROM acte_trans WHERE date_soin >= :dmin
-        )
-    """, {"dmin": DATE_MIN}, "list_acte_acte_trans (90j)")
-
-    df_ac = q(conn, "SELECT id_avenant, id_acte, forfait_acte_convention FROM actes_convention", name="actes_convention")
+    # Tarifs lus en direct (pas de cache) : une correction de tarif se voit
+    # aussitôt, et T1b reste cohérent avec T2/T3 qui joignent SQL_TARIF_LAST en base.
+    df_ac_last = q(conn, SQL_TARIF_LAST, name="actes_convention")
 
     # Référentiels (DIM) pour libellés
-    df_ss  = q(conn, "SELECT id_structure, str_id_structure, id_type_str_sante FROM structure_sante", name="structure_sante")
-    df_s   = q(conn, "SELECT code_structure, nom_structure FROM structure", name="structure")
-    df_tss = q(conn, "SELECT id_type_str_sante, libelle_type_structure_sante FROM type_str_sante", name="type_str_sante")
-    df_ad  = q(conn, "SELECT id_adherent, num_bnf, matricule, nom, prenoms, telephone FROM adherent", name="adherent")
-    df_tp  = q(conn, "SELECT id_type_prest, libelle_type_prestation, code_prestation FROM type_prestation", name="type_prestation")
-    df_act = q(conn, "SELECT id_acte, code_acte, libelle_acte FROM acte", name="acte")
-
-if df_at.empty or df_la.empty:
-    print("Aucune donnée sur la période -> arrêt.")
-    raise SystemExit(0)
+    df_ss  = load_dim(conn, "structure_sante", "SELECT id_structure, str_id_structure, id_type_str_sante FROM structure_sante", "id_structure")
+    df_s   = load_dim(conn, "structure", "SELECT code_structure, nom_structure FROM structure", "code_structure")
+    df_tss = load_dim(conn, "type_str_sante", "SELECT id_type_str_sante, libelle_type_structure_sante FROM type_str_sante", "id_type_str_sante")
+    df_ad  = load_dim(conn, "adherent", "SELECT id_adherent, num_bnf, matricule, nom, prenoms, telephone FROM adherent", "id_adherent")
+    df_tp  = load_dim(conn, "type_prestation", "SELECT id_type_prest, libelle_type_prestation, code_prestation FROM type_prestation", "id_type_prest")
+    df_act = load_dim(conn, "acte", "SELECT id_acte, code_acte, libelle_acte FROM acte", "id_acte")
+
+benef_col = "id_beneficiaire" if has_benef else "NULL AS id_beneficiaire"
+# Variante qualifiée pour les requêtes où acte_trans est aliasée `tr`
+# (jamais "tr.NULL AS ..." quand la colonne n'existe pas).
+benef_tr  = "tr.id_beneficiaire" if has_benef else "NULL AS id_beneficiaire"
+
+# Requêtes de faits construites une seule fois (schéma bénéficiaire connu) ;
+# SQLAlchemy réutilise leur forme compilée à chaque exécution.
+STMT_T2         = text(SQL_T2.format(benef_tr=benef_tr))
+STMT_T1B        = text(SQL_T1B.format(benef_tr=benef_tr))
+STMT_FLUX       = text(SQL_FLUX)
+STMT_ACTE_TRANS = text(SQL_ACTE_TRANS.format(benef=benef_col))
+STMT_T3         = text(SQL_T3)
+STMT_T4         = text(SQL_T4)
+STMT_GCONCAT_LEN = text("SET SESSION group_concat_max_len = 1048576")
 
 # =========================
 # 4) DIM (libellés)
@@ -115,130 +332,34 @@ dim_acte = df_act.rename(columns={
     "id_acte":"id_acte","code_acte":"acte_code","libelle_acte":"acte_libelle"
 })[["id_acte","acte_code","acte_libelle"]]
 
-# =========================
-# 5) Dernier tarif par acte
-# =========================
-if df_ac.empty:
-    print("ATTENTION: 'actes_convention' est vide -> T2 ne comparera pas au tarif.")
-df_ac_last = (df_ac.sort_values(["id_acte","id_avenant"])
-                   .groupby("id_acte", as_index=False)
-                   .tail(1)[["id_acte","forfait_acte_convention"]]
-                   .rename(columns={"forfait_acte_convention":"tarif_officiel"}))
-
-# =========================
-# 6) Flux transaction × acte enrichi
-# =========================
-df_tx = (df_la
-         .merge(df_at, on="id_acte_trans", how="inner")
-         .merge(df_ac_last, on="id_acte", how="left")
-         .merge(dim_struct, on="id_structure", how="left")
-         .merge(dim_benef, on="id_beneficiaire", how="left")
-         .merge(dim_tp, left_on="id_type_prest", right_on="id_type_prestation", how="left")
-         .merge(dim_acte, on="id_acte", how="left"))
-
-df_tx["montant_execute"] = df_tx["montant_acte"]
-df_tx["ecart_montant"]   = df_tx["montant_execute"] - df_tx["tarif_officiel"].fillna(0)
+# Référentiels indexés une fois par clé : l'enrichissement d'un bloc est un
+# reindex sur un index déjà haché, au lieu d'un merge qui reconstruit la
+# table de hachage du référentiel à chaque appel.
+idx_struct = dim_struct.drop_duplicates("id_structure").set_index("id_structure")
+idx_benef  = dim_benef.drop_duplicates("id_beneficiaire").set_index("id_beneficiaire")
+idx_tp     = dim_tp.drop_duplicates("id_type_prestation").set_index("id_type_prestation", drop=False)
+idx_acte   = dim_acte.drop_duplicates("id_acte").set_index("id_acte")
+
+def lookup(df, dim, on, cols=None):
+    """Colonnes de `dim` alignées ligne à ligne sur df[on] (NaN si absent)."""
+    out = dim.reindex(pd.Index(df[on]))
+    if cols:
+        out = out[cols]
+    out.index = df.index
+    return out
 
 # =========================
-# 7) Détections
+# 5) Dernier tarif par acte
 # =========================
+# Calculé côté MySQL (SQL_TARIF_LAST) ; lookup id_acte -> tarif par dict.
+if df_ac_last.empty:
+    log("ATTENTION: 'actes_convention' est vide -> T2 ne comparera pas au tarif.")
+tarifs = dict(zip(df_ac_last["id_acte"], df_ac_last["tarif_officiel"].astype(float)))
 
-# --- T2 : Surfacturation
-cond_tarif = df_tx["tarif_officiel"].notna()
-cond_surf  = df_tx["montant_execute"] > df_tx["tarif_officiel"] * (1 + T2_TOLERANCE_PCT)
-df_T2 = df_tx.loc[cond_tarif & cond_surf].copy()
-df_T2["typologie_code"] = "T2"
-df_T2["raison"] = f"Surfacturation: montant > tarif_officiel x (1+{T2_TOLERANCE_PCT:.2f})"
-
-# --- T1a : Transactions sans lignes
-ids_with_lines = set(df_la["id_acte_trans"].unique())
-df_T1a = df_at.loc[~df_at["id_acte_trans"].isin(ids_with_lines)].copy()
-df_T1a["id_acte"] = None
-df_T1a["montant_execute"] = None
-df_T1a["tarif_officiel"] = None
-df_T1a["ecart_montant"] = None
-df_T1a["typologie_code"] = "T1"
-df_T1a["raison"] = "Transaction sans actes rattachés"
-df_T1a = (df_T1a
-          .merge(dim_struct, on="id_structure", how="left")
-          .merge(dim_benef, on="id_beneficiaire", how="left")
-          .merge(dim_tp, left_on="id_type_prest", right_on="id_type_prestation", how="left"))
-
-# --- T1b : Lignes sans date d’exécution
-df_T1b = df_tx.loc[df_tx["date_execution_acte"].isna()].copy()
-df_T1b["typologie_code"] = "T1"
-df_T1b["raison"] = "Acte sans date d'exécution"
-
-# --- T3 : Collusion (structure × bénéficiaire, fenètre 7 jours)
-if df_tx["id_beneficiaire"].isna().all():
-    df_T3 = pd.DataFrame(columns=[
-        "id_structure","structure_code","structure_nom",
-        "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom",
-        "periode_debut","periode_fin","nb_actes_7j","nb_ecarts_pos_7j",
-        "typologie_code","raison"
-    ])
-else:
-    base = df_tx[[
-        "id_structure","structure_code","structure_nom",
-        "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom",
-        "date_soin","ecart_montant"
-    ]].dropna(subset=["id_beneficiaire"]).copy()
-
-    # Auto-corrélation 7j : on limite la table de droite aux colonnes minimales pour éviter les suffixes de libellés
-    a = base.merge(
-        base[["id_structure","id_beneficiaire","date_soin","ecart_montant"]],
-        on=["id_structure","id_beneficiaire"], suffixes=("_1","_2")
-    )
-    a = a[(a["date_soin_2"] >= a["date_soin_1"] - pd.Timedelta(days=7)) &
-          (a["date_soin_2"] <= a["date_soin_1"])]
-
-    g = a.groupby(
-        ["id_structure","structure_code","structure_nom",
-         "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom"],
-        as_index=False
-    ).agg(
-        periode_debut=("date_soin_2","min"),
-        periode_fin=("date_soin_2","max"),
-        nb_actes_7j=("date_soin_2","size"),
-        nb_ecarts_pos_7j=("ecart_montant_2", lambda s: (s > 0).sum())
-    )
-
-    df_T3 = g[(g["nb_actes_7j"] >= T3_MIN_ACTES_7J) &
-              (g["nb_ecarts_pos_7j"] >= T3_MIN_ECARTS_7J)].copy()
-    df_T3["typologie_code"] = "T3"
-    df_T3["raison"] = f"Collusion 7j (N>={T3_MIN_ACTES_7J}, écarts+>={T3_MIN_ECARTS_7J})"
-
-# --- T4 : Usurpation d’identité (même bénéficiaire, même jour, >= N structures)
-if df_tx["id_beneficiaire"].isna().all():
-    df_T4 = pd.DataFrame(columns=[
-        "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom",
-        "jour","nb_structures","structures","typologie_code","raison"
-    ])
-else:
-    d = df_tx[[
-        "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom",
-        "id_structure","date_soin"
-    ]].dropna(subset=["id_beneficiaire"]).copy()
-    d["jour"] = pd.to_datetime(d["date_soin"]).dt.date
-    g = d.groupby(["id_beneficiaire","beneficiaire_nom","beneficiaire_prenom","jour"]).agg(
-        nb_structures=("id_structure","nunique"),
-        structures=("id_structure", lambda x: ",".join(sorted(map(str, set(x)))))
-    ).reset_index()
-    df_T4 = g[g["nb_structures"] >= T4_MIN_STRUCTS_J].copy()
-    df_T4["typologie_code"] = "T4"
-    df_T4["raison"] = f"Même bénéficiaire dans ≥{T4_MIN_STRUCTS_J} structures le même jour"
 
 # =========================
-# 8) EXPORTS CSV
+# 6) SORTIES CSV
 # =========================
-def dump(df, name, cols=None):
-    path = os.path.join(OUT_DIR, f"{name}.csv")
-    if cols:
-        cols = [c for c in cols if c in df.columns]
-        df = df[cols]
-    df.to_csv(path, index=False)
-    print("Écrit ->", path)
-
 cols_T2 = [
     "typologie_code","raison","date_soin",
     "id_structure","structure_code","structure_nom","type_structure_libelle",
@@ -259,16 +380,6 @@ cols_T4 = [
     "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom",
     "jour","nb_structures","structures"
 ]
-
-dump(df_T1a, "auto_T1a", cols_T1)
-dump(df_T1b, "auto_T1b", cols_T1)
-dump(df_T2,  "auto_T2",  cols_T2)
-dump(df_T3,  "auto_T3",  cols_T3)
-dump(df_T4,  "auto_T4",  cols_T4)
-
-# =========================
-# 9) CONSOLIDÉ HOMOGÈNE
-# =========================
 cols_all = [
     "typologie_code","raison","date_soin","jour","periode_debut","periode_fin",
     "id_acte_trans","id_acte","acte_code","acte_libelle",
@@ -278,26 +389,210 @@ cols_all = [
     "montant_execute","tarif_officiel","ecart_montant",
     "nb_actes_7j","nb_ecarts_pos_7j","nb_structures","structures"
 ]
-def norm(df, add=None):
-    if df is None or df.empty:
-        return pd.DataFrame(columns=cols_all)
-    out = df.copy()
-    if add:
-        for k,v in add.items():
-            out[k] = v
-    for c in cols_all:
-        if c not in out.columns:
-            out[c] = None
-    return out[cols_all]
-
-df_all = pd.concat([
-    norm(df_T1a, {"typologie_code":"T1"}),
-    norm(df_T1b, {"typologie_code":"T1"}),
-    norm(df_T2,  {"typologie_code":"T2"}),
-    norm(df_T3,  {"typologie_code":"T3"}),
-    norm(df_T4,  {"typologie_code":"T4"}),
-], ignore_index=True)
-
-dump(df_all, "auto_all", cols_all)
-
-print("OK. Détection enrichie terminée.")
+
+CSV_OPTIONS = pacsv.WriteOptions(include_header=False, quoting_style="needed")
+
+def out_path(name, ext="csv"):
+    return os.path.join(OUT_DIR, f"{name}.{ext}")
+
+def open_csv(path, cols=None):
+    """Ouvre un CSV en écriture binaire, avec en-tête optionnel."""
+    f = open(path, "wb")
+    if cols:
+        f.write((",".join(cols) + "\n").encode("utf-8"))
+    return f
+
+def to_arrow(s):
+    a = pa.Array.from_pandas(s)
+    # category -> dictionary : le writer CSV attend les valeurs décodées
+    return a.dictionary_decode() if pa.types.is_dictionary(a.type) else a
+
+def write_rows(f, df, cols):
+    """Ajoute les lignes de df dans l'ordre de cols (colonnes absentes/NaN -> vide).
+    Formatage CSV natif (pyarrow, multithread) ; les colonnes absentes sont des
+    tableaux Arrow nuls, sans DataFrame élargi à tout `cols`."""
+    n = len(df)
+    arrays = []
+    for c in cols:
+        if c not in df.columns:
+            arrays.append(pa.nulls(n))
+            continue
+        try:
+            arrays.append(to_arrow(df[c]))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):  # objets de types mélangés
+            arrays.append(to_arrow(df[c].astype("string")))
+    pacsv.write_csv(pa.Table.from_arrays(arrays, names=cols), f, CSV_OPTIONS)
+
+def dump(df, name, cols):
+    path = out_path(name)
+    with open_csv(path, cols) as f:
+        write_rows(f, df, cols)
+    log(f"Écrit -> {path}")
+
+# Typologies ligne à ligne (T1a, T1b, T2) : écrites au fil des blocs, dans leur
+# CSV et dans un fragment au format consolidé (.part) recopié en fin de script.
+STREAMED = {"auto_T1a": cols_T1, "auto_T1b": cols_T1, "auto_T2": cols_T2}
+streams = {name: (open_csv(out_path(name), cols), open_csv(out_path(name, "part")))
+           for name, cols in STREAMED.items()}
+
+def emit(name, df, code, raison):
+    if df.empty:
+        return
+    df = df.assign(typologie_code=code, raison=raison)
+    f, f_all = streams[name]
+    write_rows(f, df, STREAMED[name])
+    write_rows(f_all, df, cols_all)
+
+def montants(df):
+    montant = df["montant_acte"].astype(float)
+    tarif = df["tarif_officiel"].astype(float)
+    return df.assign(montant_execute=montant, tarif_officiel=tarif,
+                     ecart_montant=montant - tarif.fillna(0))
+
+def enrich(df, acte=False):
+    parts = [df,
+             lookup(df, idx_struct, "id_structure"),
+             lookup(df, idx_benef, "id_beneficiaire"),
+             lookup(df, idx_tp, "id_type_prest")]
+    if acte:
+        parts.append(lookup(df, idx_acte, "id_acte"))
+    return pd.concat(parts, axis=1)
+
+# =========================
+# 7) Détections
+# =========================
+raison_T2 = f"Surfacturation: montant > tarif_officiel x (1+{T2_TOLERANCE_PCT:.2f})"
+
+# Tâches indépendantes, chacune sur sa propre connexion et ses propres
+# fichiers de sortie : exécutées en parallèle (le temps est surtout passé à
+# attendre MySQL, les threads suffisent).
+
+def detect_T2():
+    # --- T2 : Surfacturation (filtrée côté MySQL, seules les lignes suspectes remontent)
+    with engine.connect() as conn:
+        for chunk in q(conn, STMT_T2,
+                       {"dmin": DATE_MIN, "tol": T2_TOLERANCE_PCT},
+                       "T2 surfacturation (SQL)", chunksize=CHUNK_SIZE):
+            emit("auto_T2", enrich(montants(chunk), acte=True), "T2", raison_T2)
+
+def detect_T1b():
+    # --- T1b : Lignes sans date d’exécution (filtrées côté MySQL)
+    with engine.connect() as conn:
+        for chunk in q(conn, STMT_T1B, {"dmin": DATE_MIN},
+                       "T1b lignes sans date d'exécution (SQL)", chunksize=CHUNK_SIZE):
+            chunk = chunk.assign(tarif_officiel=chunk["id_acte"].map(tarifs))
+            emit("auto_T1b", enrich(montants(chunk), acte=True), "T1", "Acte sans date d'exécution")
+
+def detect_T1():
+    """T1a : transactions de la période sans aucune ligne d'acte.
+    Retourne les id_acte_trans ayant des lignes (tableau trié)."""
+    ids_parts = []  # id_acte_trans (uniques) vus dans les lignes, par bloc
+
+    with engine.connect() as conn:
+        for chunk in q(conn, STMT_FLUX, {"dmin": DATE_MIN},
+                       "transactions avec lignes", chunksize=CHUNK_SIZE):
+            ids_parts.append(np.unique(chunk["id_acte_trans"].dropna().to_numpy("int64")))
+
+        # Tableau trié d'entiers : appartenance testée en C (np.isin), sans set Python
+        ids_with_lines = np.unique(np.concatenate(ids_parts)) if ids_parts else np.empty(0, "int64")
+
+        # --- T1a : Transactions sans lignes
+        for chunk in q(conn, STMT_ACTE_TRANS, {"dmin": DATE_MIN},
+                       "acte_trans", chunksize=CHUNK_SIZE):
+            ids_at = chunk["id_acte_trans"].to_numpy("int64", na_value=-1)
+            t1a = chunk.loc[~np.isin(ids_at, ids_with_lines)]
+            emit("auto_T1a", enrich(t1a), "T1", "Transaction sans actes rattachés")
+
+    return ids_with_lines
+
+def detect_T3():
+    # --- T3 : Collusion (structure × bénéficiaire, fenètre 7 jours)
+    # Fenêtre glissante calculée côté MySQL (une passe par (structure, bénéficiaire)
+    # au lieu d'une auto-jointure pandas N² par groupe) ; seuls les groupes
+    # dépassant les seuils remontent, les libellés sont joints ensuite.
+    if not has_benef:
+        return pd.DataFrame(columns=[
+            "id_structure","structure_code","structure_nom",
+            "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom",
+            "periode_debut","periode_fin","nb_actes_7j","nb_ecarts_pos_7j",
+            "typologie_code","raison"
+        ])
+
+    with engine.connect() as conn:
+        g = q(conn, STMT_T3, {
+            "dmin": DATE_MIN, "t3n": T3_MIN_ACTES_7J, "t3e": T3_MIN_ECARTS_7J
+        }, "T3 collusion 7j (SQL)")
+
+    df = pd.concat([
+        g,
+        lookup(g, idx_struct, "id_structure", ["structure_code","structure_nom"]),
+        lookup(g, idx_benef, "id_beneficiaire", ["beneficiaire_nom","beneficiaire_prenom"]),
+    ], axis=1)
+    df["typologie_code"] = "T3"
+    df["raison"] = f"Collusion 7j (N>={T3_MIN_ACTES_7J}, écarts+>={T3_MIN_ECARTS_7J})"
+    return df
+
+def detect_T4():
+    # --- T4 : Usurpation d’identité (même bénéficiaire, même jour, >= N structures)
+    # Agrégation complète côté MySQL (COUNT DISTINCT / GROUP_CONCAT) ; libellés
+    # joints sur les seuls couples (bénéficiaire, jour) suspects.
+    if not has_benef:
+        return pd.DataFrame(columns=[
+            "id_beneficiaire","beneficiaire_nom","beneficiaire_prenom",
+            "jour","nb_structures","structures","typologie_code","raison"
+        ])
+
+    with engine.connect() as conn:
+        # GROUP_CONCAT est tronqué sans erreur à group_concat_max_len (1024 octets
+        # par défaut) : relevé pour cette session, `structures` reste complet.
+        conn.execute(STMT_GCONCAT_LEN)
+        g = q(conn, STMT_T4, {"dmin": DATE_MIN, "n": T4_MIN_STRUCTS_J}, "T4 multi-structures (SQL)")
+
+    df = pd.concat([
+        g, lookup(g, idx_benef, "id_beneficiaire", ["beneficiaire_nom","beneficiaire_prenom"])
+    ], axis=1)
+    df["typologie_code"] = "T4"
+    df["raison"] = f"Même bénéficiaire dans ≥{T4_MIN_STRUCTS_J} structures le même jour"
+    return df
+
+with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+    fut_T2 = pool.submit(detect_T2)
+    fut_T1b = pool.submit(detect_T1b)
+    fut_T1 = pool.submit(detect_T1)
+    fut_T3 = pool.submit(detect_T3)
+    fut_T4 = pool.submit(detect_T4)
+    fut_T2.result()
+    fut_T1b.result()
+    ids_with_lines = fut_T1.result()
+    df_T3 = fut_T3.result()
+    df_T4 = fut_T4.result()
+
+for f, f_all in streams.values():
+    f.close()
+    f_all.close()
+for name in STREAMED:
+    log(f"Écrit -> {out_path(name)}")
+
+if not ids_with_lines.size:
+    log("Aucune ligne d'acte sur la période.")
+
+# =========================
+# 8) EXPORTS CSV (agrégats)
+# =========================
+dump(df_T3,  "auto_T3",  cols_T3)
+dump(df_T4,  "auto_T4",  cols_T4)
+
+# =========================
+# 9) CONSOLIDÉ HOMOGÈNE
+# =========================
+path_all = out_path("auto_all")
+with open_csv(path_all, cols_all) as f:
+    for name in STREAMED:
+        with open(out_path(name, "part"), "rb") as part:
+            shutil.copyfileobj(part, f)
+        os.remove(out_path(name, "part"))
+    write_rows(f, df_T3, cols_all)
+    write_rows(f, df_T4, cols_all)
+log(f"Écrit -> {path_all}")
+
+log("OK. Détection enrichie terminée.")